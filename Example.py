@@ -4,10 +4,14 @@ import socketio
 from aiohttp import web, web_request
 from aiohttp_cors import setup as cors_setup, ResourceOptions
 from NetworkLoggerBackend.network_logger import NetworkLogger
+from NetworkLoggerBackend.helper_functions import dump_json, load_json
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Reject log uploads larger than this before parsing them
+MAX_UPLOAD_SIZE = 1_048_576
+
 # Using Socket.io server
 sio = socketio.AsyncServer(cors_allowed_origins="*")
 
@@ -30,20 +34,33 @@ async def disconnect(sid):
     logger.info(f"Mobile client disconnected: {sid}")
 
 
+def json_response(data, status: int = 200) -> web.Response:
+    """JSON response encoded straight to bytes (orjson when available)"""
+    return web.Response(body=dump_json(data), status=status, content_type='application/json')
+
+
 # HTTP endpoint for logging
 async def handle_network_logs(request: web_request.Request) -> web.Response:
     """Handle network log uploads"""
     try:
-        data = await request.json()
+        data = load_json(await request.read())
         result = await network_logger.handle_log_upload(data, request.remote)
-        return web.json_response(result)
+        return json_response(result)
+    except web.HTTPRequestEntityTooLarge as e:
+        logger.warning(f"Upload too large from {request.remote}: {e.text}")
+        return json_response({'success': False, 'error': 'Upload too large'}, status=413)
     except Exception as e:
         logger.error(f"Upload error: {e}")
-        return web.json_response({'success': False, 'error': str(e)}, status=500)
+        return json_response({'success': False, 'error': str(e)}, status=500)
+
+async def close_network_logger(app: web.Application) -> None:
+    """Stop background reindexing and write any pending logs on shutdown"""
+    await network_logger.close()
 
 async def main():
     """Start server"""
-    app = web.Application()
+    app = web.Application(client_max_size=MAX_UPLOAD_SIZE)
+    app.on_cleanup.append(close_network_logger)
     
     # Setup CORS
     cors = cors_setup(app, defaults={
@@ -69,7 +86,7 @@ async def main():
     
     try:
         await asyncio.Future()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Shutting down...")
         await runner.cleanup()
 
@@ -2,27 +2,312 @@
 Helper functions
 """
 
+import asyncio
+import hashlib
 import json
 import logging
+import mmap
 import os
-from typing import Dict, List, Any, Optional
-from dataclasses import asdict
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Any, Optional, Sequence, Tuple
 from .models import NetworkLogEntry
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dump_json(data: Any) -> bytes:
+    """Serialize data to compact single-line JSON bytes (orjson when available)"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def load_json(raw: Any) -> Any:
+    """Parse JSON bytes or a bytes-like buffer (orjson when available)"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    if isinstance(raw, memoryview):
+        raw = raw.tobytes()
+    return json.loads(raw)
+
+
+# Log files are newline-delimited JSON (one entry per line, oldest first) so
+# uploads only append; a file is trimmed back to max_logs once it grows past
+# max_logs * COMPACTION_FACTOR lines
+COMPACTION_FACTOR = 1.5
+
+# Files at least this large are memory-mapped rather than copied into memory
+MMAP_THRESHOLD = 1 << 20
+
+# Each log file has a <file>.bloom sidecar: a bloom filter of every
+# sessionContext field/value pair written to the file, so session-context
+# queries can skip files without reading them
+BLOOM_SIZE = 512
+_BLOOM_BITS = BLOOM_SIZE * 8
+
+# Files written before the NDJSON switch hold a single JSON array (newest first)
+_LEGACY_ARRAY_PATTERN = re.compile(rb'\s*\[')
+
+
+def _read_bytes(file_path: str) -> bytes:
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def _write_bytes(file_path: str, payload: bytes) -> None:
+    # Swap in a complete file so readers (which don't take the file lock)
+    # never see a half-written rewrite
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_path, file_path)
+
+
+def _append_bytes(file_path: str, payload: bytes) -> None:
+    with open(file_path, 'ab') as f:
+        start = f.tell()
+        try:
+            f.write(payload)
+            f.flush()
+        except BaseException:
+            # Don't leave a partial line behind (e.g. on a full disk)
+            f.truncate(start)
+            raise
+
+
+def _is_legacy_array(raw: Any) -> bool:
+    return _LEGACY_ARRAY_PATTERN.match(raw) is not None
+
+
+def encode_logs(entries: List[Dict[str, Any]]) -> bytes:
+    """Encode log dicts (newest first) as NDJSON lines (oldest first), raising if any can't be serialized"""
+    return b''.join(dump_json(entry) + b'\n' for entry in reversed(entries))
+
+
+def _decode_line(line: Any, file_path: str, logger: logging.Logger) -> Optional[Dict[str, Any]]:
+    """Decode one NDJSON line, or None (logged) if it is corrupt"""
+    try:
+        entry = load_json(line)
+    except ValueError as e:
+        logger.warning(f"Skipping corrupt log line in {file_path}: {e}")
+        return None
+    if not isinstance(entry, dict):
+        logger.warning(f"Skipping non-object log line in {file_path}")
+        return None
+    return entry
+
+
+def _decode_entries(raw: bytes, file_path: str, logger: logging.Logger) -> List[Dict[str, Any]]:
+    """Decode NDJSON (or legacy JSON array) file contents, newest first"""
+    if _is_legacy_array(raw):
+        return load_json(raw)
+    
+    # The last piece is empty, or a torn line from an interrupted append
+    lines = raw.split(b'\n')[:-1]
+    entries = []
+    for line in lines:
+        if line.strip():
+            entry = _decode_line(line, file_path, logger)
+            if entry is not None:
+                entries.append(entry)
+    entries.reverse()
+    return entries
+
+
+def _decode_mapped_entries(mapped: mmap.mmap, file_path: str, logger: logging.Logger) -> List[Dict[str, Any]]:
+    """Decode memory-mapped file contents, newest first, without copying them"""
+    with memoryview(mapped) as view:
+        if _is_legacy_array(mapped):
+            with view[:] as whole:
+                return load_json(whole)
+        
+        entries = []
+        start = 0
+        size = len(mapped)
+        while start < size:
+            end = mapped.find(b'\n', start)
+            if end == -1:
+                # Torn line from an interrupted append
+                break
+            if end > start:
+                # Release each slice even if parsing fails, or the mmap can't close
+                with view[start:end] as line:
+                    entry = _decode_line(line, file_path, logger)
+                if entry is not None:
+                    entries.append(entry)
+            start = end + 1
+    entries.reverse()
+    return entries
+
+
+def _read_entries(file_path: str, logger: logging.Logger, needles: Sequence[bytes] = ()) -> Optional[List[Dict[str, Any]]]:
+    """Decode a log file (newest first), or return None if any needle is missing from it"""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            raw = f.read()
+            if not all(needle in raw for needle in needles):
+                return None
+            return _decode_entries(raw, file_path, logger)
+        
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if not all(mapped.find(needle) != -1 for needle in needles):
+                return None
+            return _decode_mapped_entries(mapped, file_path, logger)
+
+
+def _count_entries(file_path: str, migrate: bool, logger: logging.Logger) -> Tuple[int, bool]:
+    """Count entries in a log file, and whether it is (now) in NDJSON format
+
+    With migrate set the file is prepared for appending: legacy JSON array
+    files are converted to NDJSON (or set aside if corrupt) and a torn last
+    line is cut off.
+    """
+    try:
+        raw = _read_bytes(file_path)
+    except FileNotFoundError:
+        return 0, True
+    
+    if not _is_legacy_array(raw):
+        if migrate and raw and not raw.endswith(b'\n'):
+            logger.warning(f"Removing torn last line from {file_path}")
+            os.truncate(file_path, raw.rfind(b'\n') + 1)
+        return raw.count(b'\n'), True
+    
+    try:
+        entries = load_json(raw)
+    except ValueError as e:
+        if not migrate:
+            raise
+        logger.error(f"Moving corrupt log file {file_path} aside: {e}")
+        os.replace(file_path, f"{file_path}.corrupt")
+        return 0, True
+    
+    if migrate:
+        _write_bytes(file_path, encode_logs(entries))
+    return len(entries), migrate
+
+
+def _compact_file(file_path: str, max_logs: int, logger: logging.Logger) -> bytearray:
+    """Keep only the newest max_logs valid lines of a log file, returning their bloom filter"""
+    # Appends always end with a newline, so an unterminated last line is torn
+    lines = _read_bytes(file_path).split(b'\n')[:-1]
+    kept = []
+    entries = []
+    for line in reversed(lines):
+        if len(kept) == max_logs:
+            break
+        if line.strip():
+            entry = _decode_line(line, file_path, logger)
+            if entry is not None:
+                kept.append(line)
+                entries.append(entry)
+    kept.reverse()
+    # Build the filter before touching the file, so a failure leaves both intact
+    bloom = _build_bloom(entries)
+    _write_bytes(file_path, b''.join(line + b'\n' for line in kept))
+    return bloom
+
+
+def _bloom_positions(session_field: str, session_value: Any) -> Tuple[int, int]:
+    # Values are compared as strings when querying, so hash them as strings too
+    digest = hashlib.blake2b(f"{session_field}:{session_value}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest[:4], 'little') % _BLOOM_BITS, int.from_bytes(digest[4:], 'little') % _BLOOM_BITS
+
+
+def _bloom_add(bloom: bytearray, entries: Iterable[Dict[str, Any]]) -> bool:
+    """Add entries' session context pairs, returning whether any bit was newly set"""
+    changed = False
+    for entry in entries:
+        for session_field, session_value in (entry.get('sessionContext') or {}).items():
+            for position in _bloom_positions(session_field, session_value):
+                bit = 1 << (position & 7)
+                if not bloom[position >> 3] & bit:
+                    bloom[position >> 3] |= bit
+                    changed = True
+    return changed
+
+
+def _bloom_contains(bloom: bytearray, session_field: str, session_value: Any) -> bool:
+    return all(bloom[position >> 3] & (1 << (position & 7)) for position in _bloom_positions(session_field, session_value))
+
+
+def _build_bloom(entries: Iterable[Dict[str, Any]]) -> bytearray:
+    bloom = bytearray(BLOOM_SIZE)
+    _bloom_add(bloom, entries)
+    return bloom
+
+
+def _read_bloom(file_path: str) -> Optional[bytearray]:
+    """Read a log file's bloom sidecar, or None if it has none"""
+    try:
+        bloom = bytearray(_read_bytes(f"{file_path}.bloom"))
+    except FileNotFoundError:
+        return None
+    return bloom if len(bloom) == BLOOM_SIZE else None
+
+
+def _read_or_build_bloom(file_path: str, logger: logging.Logger) -> bytearray:
+    """Read a log file's bloom sidecar, building and writing it from the file if missing"""
+    bloom = _read_bloom(file_path)
+    if bloom is None:
+        try:
+            bloom = _build_bloom(_read_entries(file_path, logger))
+        except FileNotFoundError:
+            bloom = bytearray(BLOOM_SIZE)
+        except ValueError as e:
+            # Only a corrupt legacy array gets here; none of it can be read back
+            logger.warning(f"Building empty bloom filter for unreadable {file_path}: {e}")
+            bloom = bytearray(BLOOM_SIZE)
+        _write_bloom(file_path, bloom)
+    return bloom
+
+
+def _write_bloom(file_path: str, bloom: bytearray) -> None:
+    _write_bytes(f"{file_path}.bloom", bytes(bloom))
+
+
+# <safe_ip>.json or <safe_ip>_user_<safe_user_id>.json
+_CLIENT_FILE_PATTERN = re.compile(r'^(?P<ip>.+?)(?:_user_(?P<user_id>.+))?\.json$')
+
+
+_SAFE_IP_TABLE = str.maketrans({':': '_', '.': '_'})
+_SAFE_USER_ID_TABLE = str.maketrans({'/': '_', '\\': '_'})
+
+
+@lru_cache(maxsize=2048)
+def get_safe_ip(client_ip: str) -> str:
+    """Sanitize IP address for filename (replace special chars)"""
+    return client_ip.translate(_SAFE_IP_TABLE)
+
+
+def get_safe_user_id(user_id: Any) -> str:
+    """Sanitize user ID for filename"""
+    return str(user_id).translate(_SAFE_USER_ID_TABLE)
+
 
 def get_client_file_path(log_directory: str, client_ip: str, user_id: Optional[str] = None) -> str:
     """Get the JSON file path for a specific client IP and optionally user ID"""
-    # Sanitize IP address for filename (replace special chars)
-    safe_ip = client_ip.replace(':', '_').replace('.', '_')
+    safe_ip = get_safe_ip(client_ip)
     
     # If user_id is available from session context, create user-specific file
     if user_id:
-        safe_user_id = str(user_id).replace('/', '_').replace('\\', '_')
-        return os.path.join(log_directory, f"{safe_ip}_user_{safe_user_id}.json")
+        return os.path.join(log_directory, f"{safe_ip}_user_{get_safe_user_id(user_id)}.json")
     
     return os.path.join(log_directory, f"{safe_ip}.json")
 
 
+def parse_client_file_name(filename: str) -> Optional[Tuple[str, Optional[str]]]:
+    """Split a client file name into its sanitized IP and user ID"""
+    match = _CLIENT_FILE_PATTERN.match(filename)
+    if not match:
+        return None
+    return match.group('ip'), match.group('user_id')
+
+
 def extract_user_id_from_logs(logs_data: List[Dict[str, Any]]) -> Optional[str]:
     """Extract user ID from session context in logs"""
 
@@ -34,34 +319,128 @@ def extract_user_id_from_logs(logs_data: List[Dict[str, Any]]) -> Optional[str]:
     return None
 
 
-async def save_logs_to_file(new_logs: List[NetworkLogEntry], file_path: str, max_logs: int, logger: logging.Logger) -> None:
-    """Save logs to specific JSON file"""
+def session_context_matches(session_context: Optional[Dict[str, Any]], session_field: str, session_value: Any) -> bool:
+    """Check whether a log's session context has field set to value"""
+    if not session_context or session_field not in session_context:
+        return False
+    return str(session_context[session_field]) == str(session_value)
+
+
+def _session_context_needles(session_field: str, session_value: Any) -> List[bytes]:
+    """Bytes that must appear in any file holding a matching log"""
+    needles = []
+    # Only plain ASCII text is serialized identically by every JSON writer
+    if session_field.isascii():
+        needles.append(dump_json(session_field))
+    
+    # Non-string JSON values (numbers, bools, null) may be written differently
+    # from their Python str(), e.g. 1e-07 vs 1e-7, so only use string values
+    value = str(session_value)
+    if value.isascii() and not _could_be_non_string_json(value):
+        needles.append(dump_json(value)[1:-1])
+    return needles
+
+
+def _could_be_non_string_json(value: str) -> bool:
+    if value in ('True', 'False', 'None'):
+        return True
     try:
-        # Load existing logs from this specific file
-        existing_logs = await load_logs_from_file(file_path, logger)
-        
-        # Combine logs (newest first)
-        all_logs = new_logs + existing_logs
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _to_entries(data: List[Dict[str, Any]], file_path: str, logger: logging.Logger) -> List[NetworkLogEntry]:
+    """Build NetworkLogEntry objects, skipping (and logging) malformed logs"""
+    entries = []
+    for item in data:
+        try:
+            entries.append(NetworkLogEntry(**item))
+        except TypeError as e:
+            logger.warning(f"Skipping malformed log in {file_path}: {e}")
+    return entries
+
+
+async def _get_line_count(file_path: str, logger: logging.Logger, line_counts: Dict[str, int], migrate: bool = True) -> int:
+    # Only NDJSON files have their count cached, so a legacy file is still
+    # migrated before its first append
+    count = line_counts.get(file_path)
+    if count is None:
+        count, is_ndjson = await asyncio.to_thread(_count_entries, file_path, migrate, logger)
+        if is_ndjson:
+            line_counts[file_path] = count
+    return count
+
+
+async def _get_bloom(file_path: str, logger: logging.Logger, blooms: Dict[str, bytearray]) -> bytearray:
+    bloom = blooms.get(file_path)
+    if bloom is None:
+        bloom = blooms.setdefault(file_path, await asyncio.to_thread(_read_or_build_bloom, file_path, logger))
+    return bloom
+
+
+async def _might_contain_session_context(file_path: str, session_field: str, session_value: Any, blooms: Dict[str, bytearray]) -> bool:
+    """Check a log file's bloom filter (files without one might always match)"""
+    bloom = blooms.get(file_path)
+    if bloom is None:
+        bloom = await asyncio.to_thread(_read_bloom, file_path)
+        if bloom is None:
+            return True
+        bloom = blooms.setdefault(file_path, bloom)
+    return _bloom_contains(bloom, session_field, session_value)
+
+
+# The functions below that modify or count a file take the caller's line count
+# and bloom filter caches (keyed by file path), and the caller must hold the
+# file's lock: file I/O runs in worker threads, so read-modify-write cycles on
+# the same file have to be serialized explicitly.
+
+async def save_logs_to_file(new_logs: List[Dict[str, Any]], file_path: str, max_logs: int, logger: logging.Logger,
+                            line_counts: Dict[str, int], blooms: Dict[str, bytearray], payload: Optional[bytes] = None) -> None:
+    """Append log dicts (newest first) to specific JSON file
+
+    payload is new_logs already passed through encode_logs, if the caller has
+    it. Raises only if nothing was written, so a failed save can be retried.
+    """
+    try:
+        if payload is None:
+            payload = encode_logs(new_logs)
+        count = await _get_line_count(file_path, logger, line_counts)
         
-        # Limit logs if needed
-        if len(all_logs) > max_logs:
-            all_logs = all_logs[:max_logs]
+        # Update the bloom filter first so it always covers the file (clients
+        # usually repeat the same session context, so it rarely changes)
+        bloom = await _get_bloom(file_path, logger, blooms)
+        if _bloom_add(bloom, new_logs):
+            await asyncio.to_thread(_write_bloom, file_path, bloom)
         
-        # Save to file
-        with open(file_path, 'w') as f:
-            json.dump([asdict(log) for log in all_logs], f, indent=2)
-            
+        # Append new logs to the end of the file (all or nothing)
+        await asyncio.to_thread(_append_bytes, file_path, payload)
+        count += len(new_logs)
+        line_counts[file_path] = count
     except Exception as e:
         logger.error(f"Failed to save logs to {file_path}: {e}")
         raise
+    
+    # Trim old logs once the file has grown well past the limit; the logs are
+    # already saved, so a failure here is only retried on the next append
+    if count > max_logs * COMPACTION_FACTOR:
+        try:
+            bloom = await asyncio.to_thread(_compact_file, file_path, max_logs, logger)
+            line_counts[file_path] = max_logs
+            await asyncio.to_thread(_write_bloom, file_path, bloom)
+            blooms[file_path] = bloom
+        except Exception as e:
+            logger.error(f"Failed to compact {file_path}: {e}")
 
 
-async def load_logs_from_file(file_path: str, logger: logging.Logger) -> List[NetworkLogEntry]:
-    """Load logs from specific JSON file"""
+async def load_log_dicts_from_file(file_path: str, logger: logging.Logger, max_logs: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Load raw log dicts (newest first) from specific JSON file"""
     try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-            return [NetworkLogEntry(**item) for item in data]
+        data = await asyncio.to_thread(_read_entries, file_path, logger)
+        if max_logs is not None:
+            data = data[:max_logs]
+        return data
     except FileNotFoundError:
         return []
     except Exception as e:
@@ -69,8 +448,65 @@ async def load_logs_from_file(file_path: str, logger: logging.Logger) -> List[Ne
         return []
 
 
-async def get_client_log_count(log_directory: str, client_ip: str, logger: logging.Logger) -> int:
-    """Get log count for specific client"""
-    client_file = get_client_file_path(log_directory, client_ip)
-    logs = await load_logs_from_file(client_file, logger)
-    return len(logs)
\ No newline at end of file
+async def load_logs_from_file(file_path: str, logger: logging.Logger, max_logs: Optional[int] = None) -> List[NetworkLogEntry]:
+    """Load logs (newest first) from specific JSON file"""
+    data = await load_log_dicts_from_file(file_path, logger, max_logs)
+    return _to_entries(data, file_path, logger)
+
+
+async def load_matching_logs_from_file(file_path: str, session_field: str, session_value: Any, logger: logging.Logger,
+                                       blooms: Dict[str, bytearray], max_logs: Optional[int] = None) -> List[NetworkLogEntry]:
+    """Load logs whose session context field matches value from specific JSON file"""
+    try:
+        # Skip reading files that cannot contain a match
+        if not await _might_contain_session_context(file_path, session_field, session_value, blooms):
+            return []
+        
+        # Skip parsing files whose bytes cannot contain a match
+        data = await asyncio.to_thread(_read_entries, file_path, logger, _session_context_needles(session_field, session_value))
+        if data is None:
+            return []
+        
+        if max_logs is not None:
+            data = data[:max_logs]
+        return _to_entries(
+            [item for item in data if session_context_matches(item.get('sessionContext'), session_field, session_value)],
+            file_path, logger
+        )
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        logger.error(f"Failed to load logs from {file_path}: {e}")
+        return []
+
+
+async def clear_log_file(file_path: str, logger: logging.Logger, line_counts: Dict[str, int], blooms: Dict[str, bytearray],
+                         max_logs: Optional[int] = None) -> int:
+    """Empty a specific JSON file, returning how many logs it held"""
+    try:
+        count = await _get_line_count(file_path, logger, line_counts, migrate=False)
+    except Exception as e:
+        logger.error(f"Failed to count logs in {file_path}: {e}")
+        count = 0
+    await asyncio.to_thread(_write_bytes, file_path, b'')
+    line_counts[file_path] = 0
+    
+    blooms[file_path] = bytearray(BLOOM_SIZE)
+    await asyncio.to_thread(_write_bloom, file_path, blooms[file_path])
+    
+    if max_logs is not None:
+        count = min(count, max_logs)
+    return count
+
+
+async def count_logs_in_file(file_path: str, logger: logging.Logger, line_counts: Dict[str, int], max_logs: Optional[int] = None) -> int:
+    """Count logs in specific JSON file without parsing them"""
+    try:
+        count = await _get_line_count(file_path, logger, line_counts, migrate=False)
+    except Exception as e:
+        logger.error(f"Failed to count logs in {file_path}: {e}")
+        return 0
+    
+    if max_logs is not None:
+        count = min(count, max_logs)
+    return count
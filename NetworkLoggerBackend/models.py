@@ -3,10 +3,10 @@ NetworkLogEntry
 """
 
 from typing import Dict, Any, Optional
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 
 
-@dataclass
+@dataclass(slots=True)
 class NetworkLogEntry:
     """Network log entry structure (matches frontend)"""
     timestamp: str
@@ -38,4 +38,26 @@ class NetworkLogEntry:
     # Server-added fields
     server_received_at: Optional[str] = None
     client_ip: Optional[str] = None
-    device_info: Optional[Dict[str, Any]] = None
\ No newline at end of file
+    device_info: Optional[Dict[str, Any]] = None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert to a plain dict (fast replacement for dataclasses.asdict)"""
+        return _entry_to_dict(self)
+
+
+def _build_entry_to_dict():
+    """Generate a straight-line NetworkLogEntry -> dict function from the field list"""
+    items = []
+    for field in fields(NetworkLogEntry):
+        if field.type == Optional[Dict[str, Any]]:
+            # Copy nested dicts so the result doesn't share them with the entry
+            items.append(f"{field.name!r}: None if e.{field.name} is None else dict(e.{field.name})")
+        else:
+            items.append(f"{field.name!r}: e.{field.name}")
+    
+    namespace: Dict[str, Any] = {}
+    exec(f"def _entry_to_dict(e):\n    return {{{', '.join(items)}}}\n", namespace)
+    return namespace['_entry_to_dict']
+
+
+_entry_to_dict = _build_entry_to_dict()
@@ -3,23 +3,33 @@ NetworkLogger Backend
 Creates separate JSON files for each client IP + client ID in a directory structure
 """
 
-import json
+import asyncio
+import itertools
 import logging
 import os
+from collections import defaultdict, deque
 from datetime import datetime
-from typing import Dict, List, Any, Optional
-from dataclasses import asdict
+from typing import Deque, Dict, Iterable, List, Set, Any, Optional, Tuple
 from .models import NetworkLogEntry
-from .helper_functions import get_client_file_path, extract_user_id_from_logs, save_logs_to_file, load_logs_from_file, get_client_log_count
+from .helper_functions import (
+    get_client_file_path, get_safe_ip, get_safe_user_id, parse_client_file_name, extract_user_id_from_logs, session_context_matches,
+    encode_logs, save_logs_to_file, load_logs_from_file, load_matching_logs_from_file, clear_log_file, count_logs_in_file
+)
+
+# Failed flushes are retried this many times, backing off exponentially from
+# flush_delay, before the pending logs are dropped
+MAX_FLUSH_RETRIES = 5
 
 
 class NetworkLogger:
     """Backend logger that creates separate JSON files per client IP"""
     
-    def __init__(self, log_directory: str = "./network_logs", max_logs: int = 100, enable_console_logging: bool = True):
+    def __init__(self, log_directory: str = "./network_logs", max_logs: int = 100, enable_console_logging: bool = True, flush_delay: float = 0.1, reindex_interval: Optional[float] = 30):
         self.log_directory = log_directory
         self.max_logs = max_logs
         self.enable_console_logging = enable_console_logging
+        self.flush_delay = flush_delay
+        self.reindex_interval = reindex_interval
         self.logger = logging.getLogger(__name__)
         
         # Create directory if it doesn't exist
@@ -27,11 +37,217 @@ class NetworkLogger:
         
         if enable_console_logging:
             logging.basicConfig(level=logging.INFO)
+        
+        # In-memory copy of each uploaded-to file's logs (newest first); a
+        # file's cache entry and pending writes only change under its lock
+        self._cache: Dict[str, Deque[NetworkLogEntry]] = {}
+        self._file_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        
+        # Line counts and bloom filters of files written to, loaded from disk on first use
+        self._line_counts: Dict[str, int] = {}
+        self._blooms: Dict[str, bytearray] = {}
+        
+        # Uploaded batches (raw dicts and their encoded lines) not yet written
+        # to disk, flushed after flush_delay
+        self._pending: Dict[str, List[Tuple[List[Dict[str, Any]], bytes]]] = {}
+        self._flush_failures: Dict[str, int] = {}
+        self._flush_handles: Dict[str, asyncio.TimerHandle] = {}
+        self._flush_tasks: Set[asyncio.Task] = set()
+        
+        # Index of client files by sanitized IP and user ID
+        self._files: Set[str] = set()
+        self._by_ip: Dict[str, Set[str]] = defaultdict(set)
+        self._by_user: Dict[str, Set[str]] = defaultdict(set)
+        for file_path in self._scan_log_directory():
+            self._index_file(file_path)
+        
+        # Rescans the directory every reindex_interval seconds (started on first use)
+        self._reindex_task: Optional[asyncio.Task] = None
+    
+    def _scan_log_directory(self) -> List[str]:
+        """List file paths in the log directory"""
+        with os.scandir(self.log_directory) as entries:
+            return [entry.path for entry in entries if entry.is_file()]
+    
+    def _index_file(self, file_path: str) -> None:
+        """Add a client file to the IP/user index"""
+        if file_path in self._files:
+            return
+        
+        parsed = parse_client_file_name(os.path.basename(file_path))
+        if parsed is None:
+            return
+        
+        safe_ip, safe_user_id = parsed
+        self._files.add(file_path)
+        self._by_ip[safe_ip].add(file_path)
+        if safe_user_id:
+            self._by_user[safe_user_id].add(file_path)
+    
+    def _unindex_file(self, file_path: str) -> None:
+        """Remove a client file from the IP/user index"""
+        safe_ip, safe_user_id = parse_client_file_name(os.path.basename(file_path))
+        self._files.discard(file_path)
+        self._by_ip[safe_ip].discard(file_path)
+        if not self._by_ip[safe_ip]:
+            del self._by_ip[safe_ip]
+        if safe_user_id:
+            self._by_user[safe_user_id].discard(file_path)
+            if not self._by_user[safe_user_id]:
+                del self._by_user[safe_user_id]
+        
+        self._line_counts.pop(file_path, None)
+        self._blooms.pop(file_path, None)
+        lock = self._file_locks.get(file_path)
+        if lock is not None and not lock.locked():
+            del self._file_locks[file_path]
+    
+    def _reindex(self, file_paths: List[str]) -> None:
+        """Bring the index in line with a directory scan"""
+        for file_path in file_paths:
+            self._index_file(file_path)
+        
+        # Files uploaded to since startup may not be flushed to disk yet, and
+        # a first upload holds the file's lock before its cache entry exists
+        removed = self._files - set(file_paths) - self._cache.keys() - self._pending.keys()
+        for file_path in removed:
+            lock = self._file_locks.get(file_path)
+            if lock is None or not lock.locked():
+                self._unindex_file(file_path)
+    
+    async def _periodic_reindex(self) -> None:
+        """Pick up files added or removed by other processes"""
+        while True:
+            await asyncio.sleep(self.reindex_interval)
+            try:
+                self._reindex(await asyncio.to_thread(self._scan_log_directory))
+            except Exception as e:
+                self.logger.error(f"Failed to reindex {self.log_directory}: {e}")
+    
+    def _start_reindexing(self) -> None:
+        """Start background reindexing (needs a running event loop)"""
+        if self._reindex_task is None and self.reindex_interval:
+            self._reindex_task = asyncio.get_running_loop().create_task(self._periodic_reindex())
+    
+    async def _get_cached_logs(self, file_path: str) -> Deque[NetworkLogEntry]:
+        """Get cached logs for a file, loading them from disk on first use"""
+        cached = self._cache.get(file_path)
+        if cached is None:
+            logs = await load_logs_from_file(file_path, self.logger, self.max_logs)
+            cached = deque(logs, maxlen=self.max_logs)
+            self._cache[file_path] = cached
+        return cached
+    
+    async def _load_logs(self, file_path: str) -> List[NetworkLogEntry]:
+        """Load logs for a file, from the cache when available"""
+        cached = self._cache.get(file_path)
+        if cached is not None:
+            return list(cached)
+        return await load_logs_from_file(file_path, self.logger, self.max_logs)
+    
+    async def _load_many(self, file_paths: Iterable[str]) -> List[NetworkLogEntry]:
+        """Load logs from several files concurrently"""
+        results = await asyncio.gather(*[self._load_logs(fp) for fp in file_paths])
+        return list(itertools.chain.from_iterable(results))
+    
+    async def _load_matching_logs(self, file_path: str, session_field: str, session_value: str) -> List[NetworkLogEntry]:
+        """Load logs for a file matching a session context field/value, from the cache when available"""
+        cached = self._cache.get(file_path)
+        if cached is not None:
+            return [log for log in cached if session_context_matches(log.sessionContext, session_field, session_value)]
+        return await load_matching_logs_from_file(file_path, session_field, session_value, self.logger, self._blooms, self.max_logs)
     
+    async def _count_logs(self, file_path: str) -> int:
+        """Count logs for a file, from the cache when available"""
+        cached = self._cache.get(file_path)
+        if cached is not None:
+            return len(cached)
+        async with self._file_locks[file_path]:
+            return await count_logs_in_file(file_path, self.logger, self._line_counts, self.max_logs)
     
+    async def _clear_file(self, file_path: str) -> int:
+        """Clear a file and drop its cached and pending logs"""
+        async with self._file_locks[file_path]:
+            cached = self._cache.pop(file_path, None)
+            self._pending.pop(file_path, None)
+            self._flush_failures.pop(file_path, None)
+            handle = self._flush_handles.pop(file_path, None)
+            if handle:
+                handle.cancel()
+            count = await clear_log_file(file_path, self.logger, self._line_counts, self._blooms, self.max_logs)
+        
+        # The cache also holds logs that were not flushed to disk yet
+        return len(cached) if cached is not None else count
+    
+    def _schedule_flush(self, file_path: str, delay: Optional[float] = None) -> None:
+        """Write a file's pending logs once delay (default flush_delay) has passed"""
+        if file_path in self._flush_handles:
+            return
+        loop = asyncio.get_running_loop()
+        delay = self.flush_delay if delay is None else delay
+        self._flush_handles[file_path] = loop.call_later(delay, self._start_flush, file_path)
+    
+    def _start_flush(self, file_path: str) -> None:
+        self._flush_handles.pop(file_path, None)
+        task = asyncio.ensure_future(self._flush(file_path))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+    
+    async def _flush(self, file_path: str) -> None:
+        """Write all pending logs for a file in a single append"""
+        async with self._file_locks[file_path]:
+            batches = self._pending.pop(file_path, None)
+            if not batches:
+                return
+            
+            # Newest batch first, matching the file's newest-first order (the
+            # encoded lines are oldest first, like the file)
+            logs = [log for batch, _ in reversed(batches) for log in batch]
+            payload = b''.join(lines for _, lines in batches)
+            try:
+                await save_logs_to_file(logs, file_path, self.max_logs, self.logger, self._line_counts, self._blooms, payload)
+            except Exception:
+                # save_logs_to_file already logged the failure, and raises only
+                # if nothing was written
+                failures = self._flush_failures.get(file_path, 0) + 1
+                if failures > MAX_FLUSH_RETRIES:
+                    # Give up; the cache would otherwise keep logs that are not on disk
+                    self.logger.error(f"Dropping {len(logs)} logs for {file_path} after {MAX_FLUSH_RETRIES} failed retries")
+                    self._flush_failures.pop(file_path, None)
+                    self._cache.pop(file_path, None)
+                    return
+                
+                # Keep the batches (ahead of any newer ones) so the cache and disk stay in sync
+                self._flush_failures[file_path] = failures
+                self._pending[file_path] = batches + self._pending.get(file_path, [])
+                self._schedule_flush(file_path, self.flush_delay * 2 ** failures)
+            else:
+                self._flush_failures.pop(file_path, None)
+    
+    async def flush(self) -> None:
+        """Write all pending logs to disk now (call before shutdown)"""
+        for handle in self._flush_handles.values():
+            handle.cancel()
+        self._flush_handles.clear()
+        
+        await asyncio.gather(*self._flush_tasks, *[self._flush(fp) for fp in list(self._pending)])
+    
+    async def close(self) -> None:
+        """Stop background reindexing and write all pending logs (call on shutdown)"""
+        if self._reindex_task:
+            self._reindex_task.cancel()
+            try:
+                await self._reindex_task
+            except asyncio.CancelledError:
+                pass
+            self._reindex_task = None
+        
+        await self.flush()
+
 
     async def handle_log_upload(self, request_data: Dict[str, Any], client_ip: str) -> Dict[str, Any]:
         """Handle log upload from frontend - saves to client-specific JSON file"""
+        self._start_reindexing()
 
         try:
             logs_data = request_data.get('logs', [])
@@ -39,32 +255,39 @@ class NetworkLogger:
             
             user_id = extract_user_id_from_logs(logs_data)
             
-            # Convert to NetworkLogEntry and add server info
+            # Add server info and convert to NetworkLogEntry (the raw dicts are what get saved)
+            received_at = datetime.now().isoformat()
             new_logs = []
             for log_data in logs_data:
-                    
-                log = NetworkLogEntry(**log_data)
-                log.server_received_at = datetime.now().isoformat()
-                log.client_ip = client_ip
-                log.device_info = device_info
-                new_logs.append(log)
+                log_data['server_received_at'] = received_at
+                log_data['client_ip'] = client_ip
+                log_data['device_info'] = device_info
+                new_logs.append(NetworkLogEntry(**log_data))
+            
+            # Encode now, so logs that can't be saved fail this upload only
+            payload = encode_logs(logs_data)
             
             # Get client-specific file path
             client_file = get_client_file_path(self.log_directory, client_ip, user_id)
+            self._index_file(client_file)
             
-            # Save to client's JSON file
-            await save_logs_to_file(new_logs, client_file, self.max_logs, self.logger)
+            async with self._file_locks[client_file]:
+                # Update cached logs (newest first)
+                cached = await self._get_cached_logs(client_file)
+                cached.extendleft(reversed(new_logs))
+                total_stored = len(cached)
+                
+                # Queue for the next write to client's JSON file
+                self._pending.setdefault(client_file, []).append((logs_data, payload))
+                self._schedule_flush(client_file)
             
             # Console logging
-            if self.enable_console_logging:
-                self.logger.info(f"Received {len(new_logs)} network logs from {client_ip}")
+            if self.enable_console_logging and self.logger.isEnabledFor(logging.INFO):
+                self.logger.info("Received %d network logs from %s", len(new_logs), client_ip)
                 if user_id:
-                    self.logger.info(f"User ID: {user_id}")
-                self.logger.info(f"Device info: {device_info}")
-                self.logger.info(f"Saved to: {client_file}")
-            
-            
-            total_stored = await get_client_log_count(self.log_directory, client_ip, self.logger)
+                    self.logger.info("User ID: %s", user_id)
+                self.logger.info("Device info: %s", device_info)
+                self.logger.info("Saved to: %s", client_file)
             
             return {
                 'success': True,
@@ -72,7 +295,7 @@ class NetworkLogger:
                 'total_stored': total_stored,
                 'saved_to': client_file,
                 'user_id': user_id,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': received_at
             }
             
         except Exception as e:
@@ -88,15 +311,11 @@ class NetworkLogger:
     
     async def get_logs_ip(self, client_ip: str, limit: Optional[int] = None) -> List[NetworkLogEntry]:
         """Get logs for specific client IP (all users on that IP)"""
-        safe_ip = client_ip.replace(':', '_').replace('.', '_')
-        all_logs = []
+        self._start_reindexing()
+        safe_ip = get_safe_ip(client_ip)
         
-        # Find all files for this IP (with or without user ID)
-        for filename in os.listdir(self.log_directory):
-            if filename.endswith('.json') and filename.startswith(f"{safe_ip}"):
-                file_path = os.path.join(self.log_directory, filename)
-                logs = await load_logs_from_file(file_path, self.logger)
-                all_logs.extend(logs)
+        # Load all files for this IP (with or without user ID)
+        all_logs = await self._load_many(self._by_ip.get(safe_ip, ()))
         
         # Sort by timestamp (newest first)
         all_logs.sort(key=lambda x: x.timestamp, reverse=True)
@@ -108,15 +327,12 @@ class NetworkLogger:
     
     async def clear_logs(self, client_ip: Optional[str] = None, user_id: Optional[str] = None) -> int:
         """Clear logs - optionally for specific client IP and/or user ID"""
+        self._start_reindexing()
         
         if client_ip and user_id:
             # Clear logs for specific client IP and user ID
             client_file = get_client_file_path(self.log_directory, client_ip, user_id)
-            logs = await load_logs_from_file(client_file, self.logger)
-            count = len(logs)
-            
-            with open(client_file, 'w') as f:
-                json.dump([], f)
+            count = await self._clear_file(client_file)
             
             if self.enable_console_logging:
                 self.logger.info(f"Cleared {count} logs for client {client_ip}, user {user_id}")
@@ -124,17 +340,10 @@ class NetworkLogger:
             return count
         elif client_ip:
             # Clear all logs for specific client IP (all users on that IP)
-            safe_ip = client_ip.replace(':', '_').replace('.', '_')
-            count = 0
-            
-            for filename in os.listdir(self.log_directory):
-                if filename.endswith('.json') and filename.startswith(f"{safe_ip}"):
-                    file_path = os.path.join(self.log_directory, filename)
-                    logs = await load_logs_from_file(file_path, self.logger)
-                    count += len(logs)
-                    
-                    with open(file_path, 'w') as f:
-                        json.dump([], f)
+            safe_ip = get_safe_ip(client_ip)
+            file_paths = list(self._by_ip.get(safe_ip, ()))
+            counts = await asyncio.gather(*[self._clear_file(fp) for fp in file_paths])
+            count = sum(counts)
             
             if self.enable_console_logging:
                 self.logger.info(f"Cleared {count} logs for client {client_ip}")
@@ -142,16 +351,9 @@ class NetworkLogger:
             return count
         elif user_id:
             # Clear all logs for specific user ID (across all IPs)
-            count = 0
-            
-            for filename in os.listdir(self.log_directory):
-                if filename.endswith('.json') and f'_user_{user_id}' in filename:
-                    file_path = os.path.join(self.log_directory, filename)
-                    logs = await load_logs_from_file(file_path, self.logger)
-                    count += len(logs)
-                    
-                    with open(file_path, 'w') as f:
-                        json.dump([], f)
+            file_paths = list(self._by_user.get(get_safe_user_id(user_id), ()))
+            counts = await asyncio.gather(*[self._clear_file(fp) for fp in file_paths])
+            count = sum(counts)
             
             if self.enable_console_logging:
                 self.logger.info(f"Cleared {count} logs for user {user_id}")
@@ -159,15 +361,9 @@ class NetworkLogger:
             return count
         else:
             # Clear all logs
-            total_count = 0
-            for filename in os.listdir(self.log_directory):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(self.log_directory, filename)
-                    logs = await load_logs_from_file(file_path, self.logger)
-                    total_count += len(logs)
-                    
-                    with open(file_path, 'w') as f:
-                        json.dump([], f)
+            file_paths = list(self._files)
+            counts = await asyncio.gather(*[self._clear_file(fp) for fp in file_paths])
+            total_count = sum(counts)
             
             if self.enable_console_logging:
                 self.logger.info(f"Cleared {total_count} total logs from all clients")
@@ -177,23 +373,15 @@ class NetworkLogger:
     
     async def get_total_log_count(self) -> int:
         """Get total log count across all clients"""
-        total_count = 0
-        for filename in os.listdir(self.log_directory):
-            if filename.endswith('.json'):
-                file_path = os.path.join(self.log_directory, filename)
-                logs = await load_logs_from_file(file_path, self.logger)
-                total_count += len(logs)
-        return total_count
+        self._start_reindexing()
+        file_paths = list(self._files)
+        counts = await asyncio.gather(*[self._count_logs(fp) for fp in file_paths])
+        return sum(counts)
     
     async def get_logs_user(self, user_id: str, limit: Optional[int] = None) -> List[NetworkLogEntry]:
         """Get logs for a specific user ID from session context"""
-        user_logs = []
-        
-        for filename in os.listdir(self.log_directory):
-            if filename.endswith('.json') and f'_user_{user_id}' in filename:
-                file_path = os.path.join(self.log_directory, filename)
-                logs = await load_logs_from_file(file_path, self.logger)
-                user_logs.extend(logs)
+        self._start_reindexing()
+        user_logs = await self._load_many(self._by_user.get(get_safe_user_id(user_id), ()))
         
         # Sort by timestamp (newest first)
         user_logs.sort(key=lambda x: x.timestamp, reverse=True)
@@ -205,20 +393,13 @@ class NetworkLogger:
     
     async def get_logs_session_context(self, session_field: str, session_value: str, limit: Optional[int] = None) -> List[NetworkLogEntry]:
         """Get logs matching specific session context field/value"""
+        self._start_reindexing()
 
-        matching_logs = []
-        for filename in os.listdir(self.log_directory):
-            if filename.endswith('.json'):
-                file_path = os.path.join(self.log_directory, filename)
-                logs = await load_logs_from_file(file_path, self.logger)
-
-                for log in logs:
-                    if not log.sessionContext or session_field not in log.sessionContext:
-                        continue
+        results = await asyncio.gather(*[
+            self._load_matching_logs(fp, session_field, session_value) for fp in self._files
+        ])
+        matching_logs = list(itertools.chain.from_iterable(results))
 
-                    if str(log.sessionContext[session_field]) == str(session_value):
-                        matching_logs.append(log)
-                    
         matching_logs.sort(key=lambda x: x.timestamp, reverse=True)
 
         if limit: